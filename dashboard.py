@@ -1,32 +1,77 @@
+import os
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 
 # 1. PAGE CONFIG
 st.set_page_config(layout="wide", page_title="Health Expenditure Dashboard")
 
 # 2. SESSION STATE SETUP
-if "selected_indices" not in st.session_state:
-    st.session_state.selected_indices = []
+if "selected_ids" not in st.session_state:
+    st.session_state.selected_ids = np.empty(0, dtype=np.int32)
+
+# bumped by Clear Selection: part of the chart key, so a new value resets the chart widget
+if "scatter_gen" not in st.session_state:
+    st.session_state.scatter_gen = 0
 
 if "country_selection" not in st.session_state:
     st.session_state.country_selection = [] 
 
 # 3. DATA LOADING
-@st.cache_data
-def load_data():
-    df = pd.read_csv("merged_health_data.csv")
-    return df
+DATA_FILE = "merged_health_data.parquet"
+
+# everything the panels and the heatmap read; country_code/country_y are never used
+COLUMNS = [
+    "country_x", "year", "Health expenditure per capita - Total",
+    "life_expect", "maternal_mortality", "infant_mortality", "neonatal_mortality",
+    "under_5_mortality", "prev_hiv", "inci_tuberc", "prev_undernourishment",
+]
+
+# columns drawn as marker size; pixel sizes (4-20) are precomputed per slice
+SIZE_COLS = ["life_expect", "infant_mortality"]
+
+# the prepared data, pickled to disk so a server restart skips the parquet
+# decode and index build; a single entry, there is only one dataset.
+# file_stamp (mtime, size) is only part of the cache key: a regenerated
+# parquet misses the persisted entry instead of loading the stale one. The
+# caches below that read df take it too (it rides along in df_key)
+@st.cache_data(persist="disk", max_entries=1)
+def read_data(file_stamp):
+    # parquet copy of the CSV (see convert_to_parquet.py), country_x stored as category
+    df = pd.read_parquet(DATA_FILE, columns=COLUMNS)
+    # heatmap columns, resolved once instead of select_dtypes on every rerun
+    numeric_cols = df.select_dtypes(include="number").columns.tolist()
+    # sorted (year, country) index, so row_id comes out ascending within every slice
+    df = df.set_index(["year", "country_x"]).sort_index()
+    df["row_id"] = np.arange(len(df), dtype=np.int32)
+    # one int key per row, year code * #countries + country code: ascending
+    # because the index is sorted, so filter_year can binary-search it
+    year_codes, country_codes = df.index.codes
+    pair_keys = year_codes.astype(np.int64) * len(df.index.levels[1]) + country_codes
+    # widget domains, derived once from the index levels (already sorted, unique)
+    countries = tuple(df.index.levels[1].tolist())
+    years = (int(df.index.levels[0].min()), int(df.index.levels[0].max()))
+    return df, pair_keys, numeric_cols, countries, years
 
-df = load_data()
+# one shared read-only copy per process: cache_resource skips cache_data's copy
+# on every access, and nothing below mutates df (filter_year builds new frames)
+@st.cache_resource(max_entries=1)
+def load_data(file_stamp):
+    return read_data(file_stamp)
+
+data_stat = os.stat(DATA_FILE)
+file_stamp = (data_stat.st_mtime_ns, data_stat.st_size)
+df, pair_keys, numeric_cols, all_countries, (min_year, max_year) = load_data(file_stamp)
 
 # sidebar filter
 st.sidebar.header("Filter Options")
 
 # Prevent reset bug
-all_countries = df["country_x"].unique().tolist()
 if not st.session_state.country_selection:
-    st.session_state.country_selection = all_countries[:5]
+    st.session_state.country_selection = list(all_countries[:5])
 
 selected_countries = st.sidebar.multiselect(
     "Select Countries to Compare",
@@ -34,128 +79,282 @@ selected_countries = st.sidebar.multiselect(
     key="country_selection"
 )
 
-min_year = int(df["year"].min())
-max_year = int(df["year"].max())
 selected_year = st.sidebar.slider("Select Year", min_year, max_year, max_year)
 
 # base data in year filter
-year_df = df[
-    (df["country_x"].isin(selected_countries)) & 
-    (df["year"] == selected_year)
-]
+# cached so a full rerun that revisits a (countries, year) combination reuses
+# its slice (brush clicks only rerun the fragment and never get here);
+# bounded, since every combination is a new entry;
+# file_stamp drops slices of a parquet that has since been regenerated
+@st.cache_data(max_entries=64)
+def filter_year(countries: tuple, year: int, file_stamp: tuple) -> pd.DataFrame:
+    # binary-search each selected (year, country) pair in pair_keys: no scan
+    # over the frame; pairs without data (or an unknown year) give empty ranges
+    years, country_names = df.index.levels
+    codes = country_names.get_indexer(countries)
+    targets = years.get_indexer([year])[0] * len(country_names) + codes[codes >= 0]
+    lo = np.searchsorted(pair_keys, targets, side="left")
+    hi = np.searchsorted(pair_keys, targets, side="right")
+    idx = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)] + [np.empty(0, dtype=np.intp)])
+    year_df = df.take(idx).reset_index()
+    for col in SIZE_COLS:
+        vmin, vmax = year_df[col].min(), year_df[col].max()
+        year_df[f"{col}_px"] = 4 + 16 * (year_df[col] - vmin) / (vmax - vmin) if vmax > vmin else 12.0
+    return year_df
+
+countries_key = tuple(sorted(selected_countries))
+year_df = filter_year(countries_key, selected_year, file_stamp)
 
 # brushing
 def update_brush(fig_key):
     sel = st.session_state.get(fig_key, {}).get("selection", {})
     points = sel.get("points", [])
     if points:
-        st.session_state.selected_indices = [p["point_index"] for p in points]
+        ids = np.fromiter((p["customdata"][0] for p in points), dtype=np.int32, count=len(points))
+        # sorted, duplicate-free; the chart resends its selection on every
+        # rerun until the widget is reset, which clear_selection does
+        st.session_state.selected_ids = np.unique(ids)
+
+# Clear Selection callback: runs before the rerun, and the new chart key drops
+# the widget's old selection instead of letting the browser resend it
+def clear_selection():
+    st.session_state.selected_ids = np.empty(0, dtype=np.int32)
+    st.session_state.scatter_gen += 1
 
 # filtered dataframe after brushing
-if st.session_state.selected_indices:
-    brushed_df = year_df.iloc[st.session_state.selected_indices]
-else:
-    brushed_df = year_df  # If nothing selected, show everything
+def get_brushed_df(year_df, selected_ids, columns=None):
+    # narrow the columns first so the row take below only copies those
+    out = year_df if columns is None else year_df[columns]
+    if not len(selected_ids):
+        return out  # If nothing selected, show everything
+
+    # both sides are unique int32 arrays; ids from another year/country set drop out
+    mask = np.isin(year_df["row_id"].to_numpy(), selected_ids, assume_unique=True)
+    return out.take(np.flatnonzero(mask))
+
+# correlation matrix of the brushed slice, None when there are too few rows
+# cached so reruns that leave filters and brush untouched skip the recompute
+@st.cache_data(max_entries=64)
+def compute_corr(year, countries, file_stamp, sel_ids):
+    sub = get_brushed_df(filter_year(countries, year, file_stamp), sel_ids, numeric_cols)
+    if len(sub) <= 1:
+        return None
+
+    # one float32 corrcoef over a contiguous block; NaNs (if any) imputed with
+    # the column mean, so complete data skips the extra passes
+    mat = sub.to_numpy(dtype=np.float32)
+    nan = np.isnan(mat)
+    if nan.any():
+        mat = np.where(nan, np.nanmean(mat, axis=0), mat)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = np.corrcoef(mat, rowvar=False)
+    return pd.DataFrame(corr, index=numeric_cols, columns=numeric_cols)
+
+# downsampling
+# panels above this many points get LTTB-reduced before going to the browser
+DOWNSAMPLE_THRESHOLD = 2000
+# above this many points hover picking is switched off (it scans every point)
+HOVER_MAX_POINTS = 5000
+# one colour per plotted country, in legend order, as plotly express would pick
+COLORS = px.colors.qualitative.Plotly
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: positions of n_out points that keep the shape of y over x."""
+    order = np.argsort(x, kind="stable")
+    x, y = x[order], y[order]
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return order
+
+    keep = np.empty(n_out, dtype=np.intp)
+    keep[0], keep[-1] = 0, n - 1
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            avg_x = x[hi:edges[i + 2]].mean()
+            avg_y = y[hi:edges[i + 2]].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return order[keep]
+
+# y columns for panels 3 and 4, falling back if the data lacks them
+Y_COL_UNDER = next((c for c in df.columns if "prev_unde" in c), "life_expect")
+Y_COL_NEO = next((c for c in df.columns if "neonatal_mortality" in c), "infant_mortality")
+
+# scatter panels of the 2x2 grid: (subplot title, y column, y label, size column)
+CHARTS = [
+    ("1. Preston Curve", "life_expect", "Life Expectancy", "life_expect"),
+    ("2. Spending vs. Infant Mortality", "infant_mortality", "Infant Mortality", "infant_mortality"),
+    ("3. Spending vs. Undernourishment", Y_COL_UNDER, "Undernourishment", None),
+    ("4. Spending vs. Neonatal Mortality", Y_COL_NEO, "Neonatal Mortality", None),
+]
+
+# figure builders
+# the 2x2 layout skeleton (subplot titles, axis titles, legend), built once and
+# shared via cache_resource; make_scatter only copies it, never mutates it
+@st.cache_resource
+def base_layout():
+    fig = make_subplots(rows=2, cols=2, subplot_titles=[c[0] for c in CHARTS], vertical_spacing=0.12)
+    for i, (_, _, y_label, _) in enumerate(CHARTS):
+        fig.update_xaxes(title_text="Health Expenditure", row=i // 2 + 1, col=i % 2 + 1)
+        fig.update_yaxes(title_text=y_label, row=i // 2 + 1, col=i % 2 + 1)
+    fig.update_layout(height=900, legend_title_text="country_x")
+    return fig.layout
+
+def panel_traces(_data, panel, y, y_label, size, colors):
+    # pull only the arrays the panel encodes; row_id maps brushes onto traces
+    xs = _data["Health expenditure per capita - Total"].to_numpy()
+    ys = _data[y].to_numpy()
+    row_ids = _data["row_id"].to_numpy()
+    sizes = _data[f"{size}_px"].to_numpy() if size is not None else None
+    country = _data["country_x"].cat
+    codes = country.codes.to_numpy()
+
+    # panel 1 keeps every point as the full reference; the others are
+    # downsampled. Any panel still past HOVER_MAX_POINTS loses hover (and clicking)
+    if panel > 0 and len(_data) > DOWNSAMPLE_THRESHOLD:
+        idx = lttb_indices(xs, ys, DOWNSAMPLE_THRESHOLD)
+        xs, ys, row_ids, codes = xs[idx], ys[idx], row_ids[idx], codes[idx]
+        sizes = sizes[idx] if sizes is not None else None
+    hoverable = len(xs) <= HOVER_MAX_POINTS
+
+    # one WebGL trace per country, matched on the int category codes; colours
+    # and legend entries are shared across the four panels through legendgroup
+    axis = "" if panel == 0 else str(panel + 1)
+    traces, trace_ids = [], []
+    for code in np.unique(codes):
+        rows = codes == code
+        name = country.categories[code]
+        marker = dict(color=colors[code])
+        if sizes is not None:
+            marker["size"] = sizes[rows]
+        traces.append(go.Scattergl(
+            x=xs[rows],
+            y=ys[rows],
+            name=name,
+            legendgroup=name,
+            showlegend=panel == 0,
+            mode="markers",
+            marker=marker,
+            xaxis="x" + axis,
+            yaxis="y" + axis,
+            customdata=row_ids[rows, None] if hoverable else None,
+            hoverinfo=None if hoverable else "skip",
+            # float32 values, so round to what float32 actually holds
+            hovertemplate=f"<b>{name}</b><br><br>Health Expenditure=%{{x:.6~g}}<br>{y_label}=%{{y:.6~g}}<extra></extra>"
+            if hoverable else None,
+        ))
+        # row_ids behind each trace's points, so a brush can be mapped onto them
+        trace_ids.append(row_ids[rows])
+    return traces, trace_ids
+
+# all four panels in one figure: one JSON payload, one plotly.js instance and
+# one WebGL context in the browser, one shared legend
+# cached on the (year, countries, file stamp) key: year_df is a pure function of it, so
+# reruns that don't change the key reuse the figure
+@st.cache_resource(max_entries=64)
+def make_scatter(df_key, _data):
+    # colours are fixed per country over the whole slice, so a country that
+    # LTTB drops from one panel doesn't shift the colours of the others
+    codes = np.unique(_data["country_x"].cat.codes.to_numpy())
+    colors = {code: COLORS[k % len(COLORS)] for k, code in enumerate(codes)}
+    traces, trace_ids = [], []
+    for panel, (_, y, y_label, size) in enumerate(CHARTS):
+        panel_t, panel_ids = panel_traces(_data, panel, y, y_label, size, colors)
+        traces += panel_t
+        trace_ids += panel_ids
+    fig = go.Figure(data=traces, layout=base_layout())
+    # same rule as the traces: only when a panel actually lost its hover
+    if any(t.hoverinfo == "skip" for t in traces):
+        fig.update_layout(spikedistance=0)
+    return fig, trace_ids
+
+# a brush only highlights points through plotly's own selectedpoints channel,
+# so the (cached) base figure is copied and marked rather than rebuilt
+@st.cache_resource(max_entries=64)
+def brush_scatter(brush_key, _fig, _trace_ids):
+    selected_ids = np.asarray(brush_key[1], dtype=np.int32)
+    if not len(selected_ids):
+        return _fig
+
+    fig = go.Figure(_fig)
+    for trace, ids in zip(fig.data, _trace_ids):
+        trace.selectedpoints = np.flatnonzero(np.isin(ids, selected_ids, assume_unique=True))
+    # brushed points stay as drawn, the rest fade into context
+    fig.update_traces(
+        selected=dict(marker=dict(opacity=1.0)),
+        unselected=dict(marker=dict(opacity=0.15))
+    )
+    return fig
+
+@st.cache_resource(max_entries=64)
+def make_heatmap(brush_key, _corr):
+    return px.imshow(_corr, aspect="auto", title="Correlation Heatmap")
+
+def build_all(year_df, df_key, brush_key):
+    figs = {}
+    # We use 'year_df' everywhere so you always see all points; the brush
+    # only changes which of them are highlighted
+    fig, trace_ids = make_scatter(df_key, year_df)
+    figs["scatter"] = brush_scatter(brush_key, fig, trace_ids)
+
+    # the heatmap still works on the brushed rows only
+    corr = compute_corr(*df_key, np.asarray(brush_key[1], dtype=np.int32))
+    figs["fig5"] = make_heatmap(brush_key, corr) if corr is not None else None
+    return figs
 
 # dashboard initial settings
 st.title("Analysis: Health Expenditure vs. Health Indicators")
 st.markdown(f"Exploring relationships for the year **{selected_year}**.")
 
-col1, col2 = st.columns(2)
-
-# insight 1: variation of a preston curve
-with col1:
-    st.subheader("1. Preston Curve (Selector)")
-    st.caption("Click points here to filter the other charts!")
-    
-    # We use 'year_df' here so you always see all points to click on
-    fig1 = px.scatter(
-        year_df, 
-        x="Health expenditure per capita - Total",
-        y="life_expect",
-        color="country_x",
-        size="life_expect",
-        hover_name="country_x",
-        labels={"life_expect": "Life Expectancy", "Health expenditure per capita - Total": "Health Expenditure"},
-        title="Expenditure vs. Life Expectancy"
-    )
-    # The interaction source
+# a fragment: clicking a point (or Clear Selection) reruns only this part,
+# not the sidebar and filtering; filter changes still rerun the whole script
+@st.fragment
+def render_dashboard(year_df, df_key):
+    # read the chart's selection before anything is drawn, so every panel of
+    # this run already reflects the click that triggered it
+    chart_key = f"scatter-{st.session_state.scatter_gen}"
+    update_brush(chart_key)
+    # a brush belongs to the (year, countries) slice it was drawn on; none of
+    # its row_ids exist in another slice, so a filter change drops it
+    if st.session_state.get("_brush_slice") != df_key:
+        st.session_state._brush_slice = df_key
+        st.session_state.selected_ids = np.empty(0, dtype=np.int32)
+    brush_key = (df_key, tuple(st.session_state.selected_ids.tolist()))
+
+    # every figure is a pure function of (year, countries, file stamp, brush): when that
+    # fingerprint matches the last run, reuse the whole batch as-is
+    if st.session_state.get("_fp") == brush_key:
+        figs = st.session_state["_figs"]
+    else:
+        figs = build_all(year_df, df_key, brush_key)
+        st.session_state["_fp"] = brush_key
+        st.session_state["_figs"] = figs
+
+    # insights 1-4: spending against each health indicator
+    st.subheader("1-4. Spending vs. Health Indicators")
+    st.caption("Click points in any chart to highlight them in all four!")
     st.plotly_chart(
-        fig1, use_container_width=True,
-        selection_mode="points", on_select="rerun", key="fig1"
-    )
-    update_brush("fig1")
-
-# insight 2 - impact of spending in infant mortality
-with col2:
-    st.subheader("2. Spending vs. Infant Mortality")
-    
-    # FIX: Use 'brushed_df' so this chart updates!
-    fig2 = px.scatter(
-        brushed_df,
-        x="Health expenditure per capita - Total",
-        y="infant_mortality",
-        color="country_x",
-        size="infant_mortality",
-        hover_name="country_x",
-        labels={"infant_mortality": "Infant Mortality", "Health expenditure per capita - Total": "Health Expenditure"},
-        title="Expenditure vs. Infant Mortality"
-    )
-    st.plotly_chart(fig2, use_container_width=True)
-
-col3, col4 = st.columns(2)
-
-# insight 3 - impact of spending in Undernourishment
-with col3:
-    st.subheader("3. Spending vs. Undernourishment")
-    under_cols = [c for c in df.columns if "prev_unde" in c]
-    y_col_3 = under_cols[0] if under_cols else "life_expect"
-
-    # FIX: Use 'brushed_df'
-    fig3 = px.scatter(
-        brushed_df,
-        x="Health expenditure per capita - Total",
-        y=y_col_3,
-        color="country_x",
-        hover_name="country_x",
-        labels={y_col_3: "Undernourishment", "Health expenditure per capita - Total": "Health Expenditure"},
-        title="Expenditure vs. Undernourishment"
+        figs["scatter"], use_container_width=True,
+        selection_mode="points", on_select="rerun", key=chart_key
     )
-    st.plotly_chart(fig3, use_container_width=True)
-
-# insight 4 - impact of spending in Neonatal Mortality
-with col4:
-    st.subheader("4. Spending vs. Neonatal Mortality")
-    neo_cols = [c for c in df.columns if "neonatal_mortality" in c]
-    y_col_4 = neo_cols[0] if neo_cols else "infant_mortality"
-
-    # FIX: Use 'brushed_df'
-    fig4 = px.scatter(
-        brushed_df,
-        x="Health expenditure per capita - Total",
-        y=y_col_4,
-        color="country_x",
-        hover_name="country_x",
-        labels={y_col_4: "Neonatal Mortality", "Health expenditure per capita - Total": "Health Expenditure"},
-        title="Expenditure vs. Neonatal Mortality"
-    )
-    st.plotly_chart(fig4, use_container_width=True)
-
-# insight 5 - correlation between the variables
-st.subheader("5. Global Correlations")
-col5, _ = st.columns(2)
-with col5:
-    # Use brushed_df for heatmap too
-    numeric_df = brushed_df.select_dtypes(include=["float64", "int64"])
-    if len(numeric_df) > 1:
-        corr = numeric_df.corr()
-        fig5 = px.imshow(corr, aspect="auto", title="Correlation Heatmap")
-        st.plotly_chart(fig5, use_container_width=True)
-    else:
-        st.info("Select more points to see correlations.")
 
-# clear selection
-st.markdown("---")
-if st.button("Clear Selection"):
-    st.session_state.selected_indices = []
-    st.rerun()
+    # insight 5 - correlation between the variables
+    st.subheader("5. Global Correlations")
+    col5, _ = st.columns(2)
+    with col5:
+        if figs["fig5"] is not None:
+            st.plotly_chart(figs["fig5"], use_container_width=True)
+        else:
+            st.info("Select more points to see correlations.")
+
+    # clear selection
+    st.markdown("---")
+    st.button("Clear Selection", on_click=clear_selection)
+
+render_dashboard(year_df, (selected_year, countries_key, file_stamp))